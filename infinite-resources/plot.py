@@ -1,18 +1,42 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
-import fnmatch
+import hashlib
 import os
 import json
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
-import pandas
-import seaborn as sns
+import matplotlib
+
+# We only write static images, so skip the interactive backend probe
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt  # noqa: E402
+import polars as pl  # noqa: E402
+import seaborn as sns  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 plt.style.use("bmh")
+sns.set_style("dark")
+
+# Use the bundled font so we don't search for ones that aren't installed
+plt.rcParams.update(
+    {"font.family": "DejaVu Sans", "path.simplify": True, "agg.path.chunksize": 10000}
+)
+
 here = os.path.dirname(os.path.abspath(__file__))
 
+# Columns of the parsed results data frame
+columns = ["uid", "instance", "nodes", "create_nodes", "delete_nodes", "tag", "date"]
+
+# Bump this when parse_data output changes, to invalidate cached results
+cache_version = 1
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -32,30 +56,42 @@ def get_parser():
     return parser
 
 
-def recursive_find(base, pattern="*.*"):
+def recursive_find(base, suffixes):
     """
-    Recursively find and yield files matching a glob pattern.
+    Recursively find and yield files ending with one of the suffixes.
     """
-    for root, _, filenames in os.walk(base):
-        for filename in fnmatch.filter(filenames, pattern):
-            yield os.path.join(root, filename)
+    # Like os.walk, a missing (or unreadable) directory yields nothing
+    try:
+        entries = os.scandir(base)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from recursive_find(entry.path, suffixes)
+            elif entry.name.endswith(suffixes):
+                yield entry.path
 
 
 def find_inputs(input_dir):
     """
     Find inputs (results files)
     """
-    files = []
-    for filename in recursive_find(input_dir, pattern="*.json"):
-        # We only have data for small
-        files.append(filename)
-    return files
+    files = {}
+    for filename in recursive_find(input_dir, suffixes=(".json", ".jsonl")):
+        # Prefer json lines results (written as we go) for the same run
+        base, ext = os.path.splitext(filename)
+        if ext == ".jsonl" or base not in files:
+            files[base] = filename
+    return list(files.values())
 
 
 def read_json(path):
-    with open(path, "r") as fd:
-        content = json.loads(fd.read())
-    return content
+    with open(path, "rb") as fd:
+        content = fd.read()
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
 
 
 def main():
@@ -78,8 +114,10 @@ def main():
 
     # This does the actual parsing of data into a formatted variant
     # Has keys results, iters, and columns
-    df = parse_data(files)
-    df.to_csv(os.path.join(outdir, "instance-times.csv"))
+    df = load_data(files, outdir)
+    df.write_csv(os.path.join(outdir, "instance-times.csv"))
+    df.write_parquet(os.path.join(outdir, "instance-times.parquet"), compression="zstd")
+    summarize_data(df).write_csv(os.path.join(outdir, "instance-times-summary.csv"))
     plot_results(df, outdir)
 
 
@@ -88,29 +126,29 @@ def plot_results(df, outdir):
     Plot lammps results
     """
     # Plot each!
-    types = list(df.nodes.unique())
-    types.sort()
-    tags = list(df.tag.unique())
-    tags.sort()
+    types = sorted(df["nodes"].unique().to_list())
+    tags = sorted(df["tag"].unique().to_list())
 
     # ALWAYS double check this ordering, this
     # is almost always wrong and the colors are messed up
-    colors = sns.color_palette("hls", 16)
-    hexcolors = colors.as_hex()
-    palette_tags = collections.OrderedDict()
-    for t in tags:
-        palette_tags[t] = hexcolors.pop(0)
-
-    colors = sns.color_palette("hls", 16)
-    hexcolors = colors.as_hex()
-    palette = collections.OrderedDict()
-    for t in types:
-        palette[t] = hexcolors.pop(0)
-
-    for instance in df.instance.unique():
-        subset = df[df.instance == instance]
+    hexcolors = sns.color_palette("hls", max(len(tags), len(types), 16)).as_hex()
+    palette_tags = dict(zip(tags, hexcolors))
+    palette = dict(zip(types, hexcolors))
+
+    # Share one figure across plots (clearing the axes between them)
+    fig, ax = plt.subplots(figsize=(24, 12))
+
+    # Partition by instance in one pass. Seaborn needs pandas, so only
+    # convert each subset we plot
+    for subset in df.partition_by("instance", maintain_order=True):
+        instance = subset["instance"][0]
+
+        # Categories are shared across instances, so only show tags we have
+        tag_order = subset["tag"].unique(maintain_order=True).to_list()
+        subset = subset.to_pandas()
         make_plot(
             subset,
+            ax=ax,
             title=f"Node Group Creation Times for Instance {instance}",
             tag=f"{instance}_creation_times",
             ydimension="create_nodes",
@@ -126,6 +164,7 @@ def plot_results(df, outdir):
         )
         make_plot(
             subset,
+            ax=ax,
             title=f"Node Group Deletion Times for Instance {instance}",
             tag=f"{instance}_deletion_times",
             ydimension="delete_nodes",
@@ -142,6 +181,7 @@ def plot_results(df, outdir):
 
         make_plot(
             subset,
+            ax=ax,
             title=f"Node Group Creation Times for Instance {instance} by time of day",
             tag=f"{instance}_creation_times_time_of_day",
             ydimension="create_nodes",
@@ -151,12 +191,14 @@ def plot_results(df, outdir):
             ext="png",
             plotname=f"{instance}_deletion_times_time_of_day",
             hue="tag",
+            hue_order=tag_order,
             plot_type="bar",
             xlabel="Size (nodes)",
             ylabel="Time (seconds)",
         )
         make_plot(
             subset,
+            ax=ax,
             title=f"Node Group Deletion Times for Instance {instance} by time of day",
             tag=f"{instance}_deletion_times_time_of_day",
             ydimension="delete_nodes",
@@ -166,58 +208,137 @@ def plot_results(df, outdir):
             ext="png",
             plotname=f"{instance}_deletion_times_time_of_day",
             hue="tag",
+            hue_order=tag_order,
             plot_type="bar",
             xlabel="Size (nodes)",
             ylabel="Time (seconds)",
         )
+    plt.close(fig)
+
+
+def load_data(files, outdir):
+    """
+    Parse results into a data frame, cached until any results file changes
+    """
+    signature = sorted((filename, os.stat(filename).st_mtime_ns) for filename in files)
+    key = repr((cache_version, columns, signature))
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    cache_dir = os.path.join(outdir, ".cache")
+    cache_file = os.path.join(cache_dir, f"{digest}.parquet")
+    if os.path.exists(cache_file):
+        return pl.read_parquet(cache_file)
+
+    df = parse_data(files)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Only the latest parse is useful, so remove stale entries
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".parquet"):
+                os.remove(entry.path)
+    df.write_parquet(cache_file, compression="zstd")
+    return df
 
 
 def parse_data(files):
     """
     Given a listing of files, parse into results data frame
     """
-    # Parse into data frame
-    df = pandas.DataFrame(
-        columns=[
-            "uid",
-            "instance",
-            "nodes",
-            "create_nodes",
-            "delete_nodes",
-            "tag",
-            "date",
-        ]
+    # Read (and decode) result files concurrently to overlap I/O latency
+    with ThreadPoolExecutor(max_workers=min(32, len(files) or 1)) as executor:
+        frames = list(executor.map(read_results, files))
+
+    # Narrow types to shrink memory (and what seaborn needs to copy)
+    return pl.concat(frames, how="vertical_relaxed").with_columns(
+        pl.col("nodes").cast(pl.Int32),
+        pl.col("create_nodes", "delete_nodes").cast(pl.Float32),
+        pl.col("instance", "tag", "date").cast(pl.Categorical),
     )
-    idx = 0
 
-    for filename in files:
-        parsed = os.path.relpath(filename, here)
-        pieces = parsed.split(os.sep)
-        tag = pieces[-3]
-        date = pieces[-4]
 
-        item = read_json(filename)
+def read_results(filename):
+    """
+    Read one results file (json or json lines) into a data frame
+    """
+    # Tag and date come from the results path
+    date, tag = pathlib.PurePath(filename).parts[-4:-2]
+
+    # Json lines results have one experiment per line, so we can hand
+    # them straight to the polars reader
+    if filename.endswith(".jsonl"):
+        df = pl.read_ndjson(filename).unnest("times")
 
         # We just care about total wall time
-        for uid, datum in item["experiments"].items():
-            if "create_cluster_nodes" not in datum["times"]:
-                continue
-            df.loc[idx, :] = [
-                datum["id"],
-                datum["machine_type"],
-                datum["size"],
-                datum["times"]["create_cluster_nodes"],
-                datum["times"]["delete_nodegroup"],
-                tag,
-                date,
-            ]
-            idx += 1
+        if "create_cluster_nodes" not in df.columns:
+            return pl.DataFrame(schema=columns)
+
+        # Deletion can fail for every size we have
+        if "delete_nodegroup" not in df.columns:
+            df = df.with_columns(
+                pl.lit(None, dtype=pl.Float64).alias("delete_nodegroup")
+            )
+
+        # A resumed run appends failed sizes again, so keep the last result
+        df = df.unique(subset="id", keep="last", maintain_order=True)
+        return df.filter(pl.col("create_cluster_nodes").is_not_null()).select(
+            pl.col("id").alias("uid"),
+            pl.col("machine_type").alias("instance"),
+            pl.col("size").alias("nodes"),
+            pl.col("create_cluster_nodes").alias("create_nodes"),
+            pl.col("delete_nodegroup").alias("delete_nodes"),
+            pl.lit(tag).alias("tag"),
+            pl.lit(date).alias("date"),
+        )
 
-    return df
+    # We just care about total wall time
+    item = read_json(filename)
+    records = [
+        {
+            "uid": datum["id"],
+            "instance": datum["machine_type"],
+            "nodes": datum["size"],
+            "create_nodes": datum["times"]["create_cluster_nodes"],
+            "delete_nodes": datum["times"].get("delete_nodegroup"),
+            "tag": tag,
+            "date": date,
+        }
+        for datum in item["experiments"].values()
+        if "create_cluster_nodes" in datum["times"]
+    ]
+
+    # Build the data frame once (assigning row by row is quadratic)
+    return pl.DataFrame(records, schema=columns, infer_schema_length=None)
+
+
+def summarize_data(df):
+    """
+    Summarize times per instance and size, matching the plot whiskers
+    """
+    quantiles = {"p5": 0.05, "median": 0.5, "p95": 0.95}
+
+    # Times are stored as float32 but recorded to the millisecond, so round
+    # Instance is categorical, so sort on the name (not discovery order)
+    return (
+        df.group_by(["instance", "nodes"], maintain_order=True)
+        .agg(
+            [
+                pl.col(column)
+                .cast(pl.Float64)
+                .quantile(q, interpolation="linear")
+                .round(3)
+                .alias(f"{column}_{name}")
+                for column in ["create_nodes", "delete_nodes"]
+                for name, q in quantiles.items()
+            ]
+        )
+        .sort(pl.col("instance").cast(pl.String), "nodes")
+    )
 
 
 def make_plot(
     df,
+    ax,
     title,
     tag,
     ydimension,
@@ -229,6 +350,7 @@ def make_plot(
     plotname="lammps",
     plot_type="violin",
     hue="experiment",
+    hue_order=None,
     outdir="img",
 ):
     """
@@ -239,25 +361,25 @@ def make_plot(
         plotfunc = sns.violinplot
 
     ext = ext.strip(".")
-    plt.figure(figsize=(24, 12))
-    sns.set_style("dark")
-    ax = plotfunc(
+    ax.clear()
+    plotfunc(
         x=xdimension,
         y=ydimension,
         hue=hue,
+        hue_order=hue_order,
         data=df,
         linewidth=0.8,
         palette=palette,
         whis=[5, 95],
+        ax=ax,
     )
 
-    plt.title(title)
+    ax.set_title(title)
     ax.set_xlabel(xlabel, fontsize=16)
     ax.set_ylabel(ylabel, fontsize=16)
     ax.set_xticklabels(ax.get_xmajorticklabels(), fontsize=14)
     ax.set_yticklabels(ax.get_yticks(), fontsize=14)
-    plt.savefig(os.path.join(outdir, f"{tag}_{plotname}.{ext}"))
-    plt.clf()
+    ax.figure.savefig(os.path.join(outdir, f"{tag}_{plotname}.{ext}"))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import copy
 import json
 import os
 import time
@@ -10,6 +9,11 @@ from datetime import datetime
 
 from kubescaler.scaler.google import GKECluster
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # import the script we have two levels up
 here = os.path.abspath(os.path.dirname(__file__))
 root = os.path.dirname(here)
@@ -98,8 +102,7 @@ class Experiment:
                 f"Experiment {self.id} is missing one of sizes.min, max, or increment."
             )
 
-        for i in range(sizes["min"], sizes["max"], sizes["increment"]):
-            self.sizes.add(i)
+        self.sizes = set(range(sizes["min"], sizes["max"], sizes["increment"]))
 
         # Always make sure we have the max size
         self.sizes.add(sizes["max"])
@@ -125,9 +128,20 @@ def read_json(filename):
     """
     Read json from file.
     """
-    with open(filename, "r") as fd:
-        content = json.loads(fd.read())
-    return content
+    with open(filename, "rb") as fd:
+        content = fd.read()
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def read_jsonl(filename):
+    """
+    Read json lines from file.
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(filename, "rb") as fd:
+        return [loads(line) for line in fd if line.strip()]
 
 
 def confirm_action(question):
@@ -167,21 +181,79 @@ def generate_uid(params):
     """
     Generate a unique id based on params.
     """
-    uid = ""
-    for k, v in params.items():
-        if not isinstance(v, dict):
-            uid += k.lower() + "-" + str(v).lower()
-        else:
-            uid += k.lower()
-    return uid
+    return "".join(
+        k.lower() if isinstance(v, dict) else f"{k.lower()}-{str(v).lower()}"
+        for k, v in params.items()
+    )
 
 
 def write_json(obj, filename):
     """
     write json to output file
     """
-    with open(filename, "w") as fd:
-        fd.write(json.dumps(obj, indent=4))
+    # orjson only supports two space indentation, so keep the fallback consistent
+    if orjson is not None:
+        content = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        content = json.dumps(obj, indent=2).encode("utf-8")
+    with open(filename, "wb") as fd:
+        fd.write(content)
+
+
+def append_jsonl(obj, filename):
+    """
+    append json as one line to a json lines output file
+    """
+    if orjson is not None:
+        content = orjson.dumps(obj)
+    else:
+        content = json.dumps(obj).encode("utf-8")
+    with open(filename, "ab") as fd:
+        fd.write(content + b"\n")
+
+
+def format_time(seconds):
+    """
+    Format a recorded time for display, or note that it failed.
+    """
+    if seconds is None:
+        return "failed"
+    return f"{seconds:.1f}s"
+
+
+def retry(func, *args, attempts=3, delay=30, before_retry=None, **kwargs):
+    """
+    Call a function, backing off exponentially between failed attempts.
+
+    Returns the errors from failed attempts, so if none succeeded there
+    is one per attempt. If provided, before_retry is called before each retry.
+    """
+    errors = []
+    for attempt in range(attempts):
+        if attempt and before_retry is not None:
+            before_retry()
+        try:
+            func(*args, **kwargs)
+            return errors
+        except Exception as e:
+            print(f"Attempt {attempt + 1} of {attempts} failed: {e}")
+            errors.append(str(e))
+            if attempt < attempts - 1:
+                time.sleep(delay * 2**attempt)
+    return errors
+
+
+def cleanup_nodegroup(node_pool_name):
+    """
+    Delete a node group that may only be partially created, ignoring errors.
+    """
+    try:
+        cli.delete_nodegroup(node_pool_name)
+    except Exception as e:
+        print(f"Issue cleaning up {node_pool_name}: {e}")
+
+    # This is not a deletion time we want to record
+    cli.times.pop("delete_nodegroup", None)
 
 
 def run_experiments(experiments, args):
@@ -230,7 +302,7 @@ def run_experiments(experiments, args):
     # Save results here as we go
     # Note that this can store multiple experiments, but for data parsing
     # and being conservative I'm running them individually
-    results = copy.deepcopy(cli.times)
+    results = dict(cli.times)
     results["experiments"] = {}
     results["start_time"] = str(datetime.now())
     results["cluster_name"] = args.cluster_name
@@ -252,9 +324,22 @@ def run_experiments(experiments, args):
             os.makedirs(path)
         outfile = os.path.join(path, "results.json")
 
+        # Each result is appended here as it finishes
+        jsonl_file = os.path.join(path, "results.jsonl")
+
+        # If we are re-running, keep (and skip) the sizes that completed.
+        # Sizes that did not get both times are run again.
+        if os.path.exists(jsonl_file):
+            for result in read_jsonl(jsonl_file):
+                if {"create_cluster_nodes", "delete_nodegroup"} - set(result["times"]):
+                    continue
+                results["experiments"][result["id"]] = result
+
         # The set will be out of order
-        sizes = list(exp.sizes)
-        sizes.sort()
+        sizes = sorted(exp.sizes)
+
+        # Attempts for each node group create and delete
+        attempts = 3
 
         # For each size batches:
         for size in sizes:
@@ -268,55 +353,66 @@ def run_experiments(experiments, args):
                 continue
             print(f"⭐️ Size {node_pool_name}")
 
-            # Keep track if we had a failure
-            failure_create = 0
-            failure_delete = 0
-
-            # This will wait for the cluster to be ready again. Also note I've seen it sometimes fail.
-            # We should add a try / catch for that. We can ask for COMPACT or TIER_1 but most
-            # instance types don't support it.
-            try:
-                cli.create_cluster_nodes(
-                    node_pool_name,
-                    node_count=size,
-                    machine_type=exp.machine_type,
-                    placement_policy="COMPACT",
-                    threads_per_core=1,
+            # This will wait for the cluster to be ready again. Also note I've seen it sometimes fail,
+            # so we retry, first cleaning up anything a failed attempt created.
+            # We can ask for COMPACT or TIER_1 but most instance types don't support it.
+            # kubescaler only times the attempt that succeeds, so we also keep the
+            # total time and every failure (e.g., a stockout), which we are measuring.
+            start = time.time()
+            create_errors = retry(
+                cli.create_cluster_nodes,
+                node_pool_name,
+                node_count=size,
+                machine_type=exp.machine_type,
+                placement_policy="COMPACT",
+                threads_per_core=1,
+                attempts=attempts,
+                before_retry=lambda: cleanup_nodegroup(node_pool_name),
+            )
+            create_total = time.time() - start
+            created = len(create_errors) < attempts
+
+            # Now time deletion. If creation failed there may be nothing to
+            # delete, so just clean up without counting a failure
+            delete_errors = []
+            deleted = False
+            if created:
+                delete_errors = retry(
+                    cli.delete_nodegroup, node_pool_name, attempts=attempts
                 )
-            except:
+                deleted = len(delete_errors) < attempts
+                if not deleted:
+                    print(f"Failure deleting size {size}")
+            else:
                 print(f"Failure creating size {size}")
-                failure_create += 1
-                import IPython
-
-                IPython.embed()
-
-            # Now time deletion
-            try:
-                cli.delete_nodegroup(node_pool_name)
-            except:
-                print(f"Failure deleting size {size}")
-                failure_delete += 1
-                import IPython
-
-                IPython.embed()
+                cleanup_nodegroup(node_pool_name)
 
             # A new result object for each.
             result = {
-                "times": copy.deepcopy(cli.times),
+                "times": dict(cli.times),
                 "metadata": exp.export(),
                 "machine_type": exp.machine_type,
                 "id": node_pool_name,
                 "size": size,
                 "day": today,
                 "tag": args.tag,
-                "failure_create": failure_create,
-                "failure_delete": failure_delete,
+                "create_total": round(create_total, 3),
+                "create_attempts": len(create_errors) + int(created),
+                "delete_attempts": len(delete_errors) + int(deleted),
+                "create_errors": create_errors,
+                "delete_errors": delete_errors,
+                "failure_create": len(create_errors),
+                "failure_delete": len(delete_errors),
             }
 
             # Show and save results as we go
             results["experiments"][node_pool_name] = result
-            print(json.dumps(results))
-            write_json(results, outfile)
+            print(
+                f"size={size} "
+                f"create={format_time(result['times'].get('create_cluster_nodes'))} "
+                f"delete={format_time(result['times'].get('delete_nodegroup'))}"
+            )
+            append_jsonl(result, jsonl_file)
 
     print("Experiments are done!")
 